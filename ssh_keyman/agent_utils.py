@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+from ssh_keyman.keys_utils import (
+    get_agent_fingerprints,
+    get_ssh_key_fingerprint,
+    get_ssh_key_list,
+    load_ssh_key,
+)
+from ssh_keyman.luks_utils import close_luks_vault, open_luks_vault
+
+
+def new_refresh_state(lifetime):
+    """
+    Create the state tracked while keeping keys loaded.
+    """
+    return {
+        "lifetime": lifetime,
+        "refreshes": 0,
+        "next_check": None,
+        "unlocks": {"count": 0, "last_duration": None, "total_duration": 0.0},
+        "keys": {},
+    }
+
+
+def get_due_keys(state, now, window, agent_fingerprints):
+    """
+    Get the keys which expire within the refresh window or are missing from the agent.
+    """
+    return [
+        key
+        for key, info in state["keys"].items()
+        if info["expires"] - now <= window
+        or info["fingerprint"] not in agent_fingerprints
+    ]
+
+
+def get_refresh_delay(state, now, window, interval):
+    """
+    Get the seconds to wait before the next check of the agent.
+
+    The agent is checked at least every interval seconds for missing keys, and in
+    time to refresh the first key entering the refresh window.
+    """
+    delay = interval
+    if state["keys"]:
+        earliest = min(info["expires"] for info in state["keys"].values())
+        delay = min(delay, earliest - window - now)
+    return max(delay, 1)
+
+
+def get_refresh_expiry(state, due, now, horizon):
+    """
+    Get the expiry for keys refreshed now, aligned with the keys which are not due.
+
+    Keys re-added out of cycle, because they went missing from the agent or are new
+    in the vault, expire together with the other keys so that all keys are
+    refreshed with the same unlock. Returns None to use the full lifetime.
+    """
+    expires = [info["expires"] for key, info in state["keys"].items() if key not in due]
+    if expires and min(expires) - now > horizon:
+        return min(expires)
+    return None
+
+
+def refresh_keys(vault_path, passphrase, state, due, lock, expires=None, window=0):
+    """
+    Re-add due keys and add new keys from the vault with the vault opened once.
+
+    Keys are added until expires if given, otherwise for the full lifetime. The
+    full lifetime is also used if less than window seconds are left until expires
+    once the vault is unlocked. Returns the list of keys added to the agent.
+    """
+    start = time.monotonic()
+    mnt = open_luks_vault(vault_path, passphrase)
+    added = []
+    try:
+        now = time.time()
+        lifetime = state["lifetime"]
+        if expires and expires - now > window:
+            lifetime = int(expires - now)
+        keys = {}
+        for key in get_ssh_key_list(mnt):
+            info = state["keys"].get(key)
+            if info and key not in due:
+                keys[key] = info
+                continue
+            path = os.path.join(mnt, key)
+            fingerprint = get_ssh_key_fingerprint(path)
+            load_ssh_key(path, lifetime)
+            keys[key] = {
+                "fingerprint": fingerprint,
+                "expires": now + lifetime,
+                "refreshes": info["refreshes"] + 1 if info else 0,
+            }
+            added.append(key)
+    finally:
+        close_luks_vault()
+        duration = time.monotonic() - start
+        with lock:
+            state["unlocks"]["count"] += 1
+            state["unlocks"]["last_duration"] = duration
+            state["unlocks"]["total_duration"] += duration
+    with lock:
+        # keys removed from the vault are no longer tracked
+        state["keys"] = keys
+        state["refreshes"] += 1
+    logging.info(f"Refreshed {len(added)} keys in {duration:.2f}s")
+    return added
+
+
+def get_refresh_status(state, lock):
+    """
+    Get a snapshot of the refresh state with the remaining lifetime of each key.
+    """
+    now = time.time()
+    with lock:
+        status = json.loads(json.dumps(state))
+    for info in status["keys"].values():
+        info["expires_in"] = info["expires"] - now
+    return status
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove a socket left behind at path by an instance which is no longer running.
+    """
+    if not os.path.lexists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+        raise FileExistsError(f"{socket_path} already exists and is not a socket.")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except OSError:
+            # nothing is listening on the socket
+            os.remove(socket_path)
+            logging.debug(f"Removed stale socket {socket_path}")
+            return
+    raise FileExistsError(f"{socket_path} is in use by another instance.")
+
+
+def start_status_server(socket_path, state, lock):
+    """
+    Serve the refresh status as JSON to each connection on a unix socket.
+    """
+
+    class StatusHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            status = get_refresh_status(state, lock)
+            self.request.sendall(json.dumps(status).encode() + b"\n")
+
+    remove_stale_socket(socket_path)
+    # only the owner may read the status
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, StatusHandler)
+    finally:
+        os.umask(umask)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.debug(f"Serving status on {socket_path}")
+    return server
+
+
+def keep_loaded(
+    vault_path,
+    passphrase,
+    lifetime,
+    window,
+    interval=60,
+    socket_path=None,
+):
+    """
+    Keep the keys in the vault loaded in the agent with a limited lifetime.
+
+    Keys are re-added when they come within window seconds of expiring or go
+    missing from the agent. Each unlock of the vault also re-adds keys which would
+    be due before the next check, and keys re-added out of cycle expire with the
+    other keys, so that all keys keep being refreshed with one unlock. A failed
+    refresh is retried after at least interval seconds. Runs until interrupted.
+    """
+    state = new_refresh_state(lifetime)
+    lock = threading.Lock()
+    server = start_status_server(socket_path, state, lock) if socket_path else None
+    try:
+        # initial load of all keys, errors here are fatal
+        refresh_keys(vault_path, passphrase, state, [], lock)
+        failed = False
+        while True:
+            now = time.time()
+            delay = get_refresh_delay(state, now, window, interval)
+            if failed:
+                # do not retry a failing refresh every second
+                delay = max(delay, interval)
+            with lock:
+                state["next_check"] = now + delay
+            time.sleep(delay)
+
+            failed = False
+            try:
+                now = time.time()
+                agent_fingerprints = get_agent_fingerprints()
+                if get_due_keys(state, now, window, agent_fingerprints):
+                    # also refresh keys which would be due before the next check
+                    horizon = window + interval
+                    due = get_due_keys(state, now, horizon, agent_fingerprints)
+                    expires = get_refresh_expiry(state, due, now, horizon)
+                    refresh_keys(
+                        vault_path, passphrase, state, due, lock, expires, window
+                    )
+            except Exception as e:
+                # retry on the next check
+                logging.error(f"Error: {e}")
+                failed = True
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+            os.remove(socket_path)
@@ -0,0 +1,246 @@
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import subprocess
+import tarfile
+
+from ssh_keyman.keys_utils import delete_ssh_key, get_ssh_key_list, write_ssh_key
+from ssh_keyman.luks_utils import (
+    backup_luks_header,
+    close_luks_vault,
+    open_luks_vault,
+)
+
+backup_version = 1
+metadata_name = "metadata.json"
+
+
+def openssl_cmd(pass_fd, decrypt=False):
+    """
+    Build the openssl command used to encrypt or decrypt backup archives.
+    """
+    cmd = ["openssl", "enc", "-aes-256-cbc", "-pbkdf2", "-salt"]
+    if decrypt:
+        cmd.append("-d")
+    return cmd + ["-pass", f"fd:{pass_fd}"]
+
+
+def pass_pipe(passphrase):
+    """
+    Create a pipe holding the passphrase, returning the read end.
+    """
+    r, w = os.pipe()
+    os.write(w, f"{passphrase}\n".encode())
+    os.close(w)
+    return r
+
+
+def hash_ssh_key(data):
+    """
+    Get the content hash of an SSH key.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_vault_keys(mnt):
+    """
+    Read the contents and permissions of keys stored at mount point.
+    """
+    keys = {}
+    for key in get_ssh_key_list(mnt):
+        path = os.path.join(mnt, key)
+        with open(path, "rb") as f:
+            keys[key] = (f.read(), os.stat(path).st_mode & 0o777)
+    return keys
+
+
+def write_backup(archive_path, passphrase, metadata, keys):
+    """
+    Stream metadata and keys into a compressed, encrypted archive.
+
+    The archive is removed again if it could not be written completely.
+    """
+    pass_fd = pass_pipe(passphrase)
+    cmd = openssl_cmd(pass_fd)
+    try:
+        out = open(archive_path, "xb")
+    except OSError:
+        os.close(pass_fd)
+        raise
+    try:
+        with out:
+            proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=out, pass_fds=(pass_fd,)
+            )
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|gz") as tar:
+                members = [(metadata_name, json.dumps(metadata).encode(), 0o600)]
+                members += [
+                    (f"keys/{key}", data, mode) for key, (data, mode) in keys.items()
+                ]
+                for name, data, mode in members:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mode = mode
+                    info.mtime = int(datetime.datetime.now().timestamp())
+                    tar.addfile(info, io.BytesIO(data))
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+    except BaseException:
+        # do not leave a partial archive behind
+        os.remove(archive_path)
+        raise
+    finally:
+        os.close(pass_fd)
+    logging.debug(f"Wrote {len(keys)} keys to backup {archive_path}")
+
+
+def read_backup(archive_path, passphrase):
+    """
+    Read metadata and keys from a compressed, encrypted archive.
+    """
+    pass_fd = pass_pipe(passphrase)
+    cmd = openssl_cmd(pass_fd, decrypt=True)
+    try:
+        with open(archive_path, "rb") as src:
+            proc = subprocess.Popen(
+                cmd, stdin=src, stdout=subprocess.PIPE, pass_fds=(pass_fd,)
+            )
+    finally:
+        os.close(pass_fd)
+    metadata = None
+    keys = {}
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|gz") as tar:
+            for info in tar:
+                data = tar.extractfile(info).read()
+                if info.name == metadata_name:
+                    metadata = json.loads(data)
+                elif info.name.startswith("keys/"):
+                    key = info.name[len("keys/") :]
+                    # do not let archive members escape the vault
+                    if key != os.path.basename(key) or key in ("", ".", ".."):
+                        raise ValueError(f"Invalid key name {key} in backup")
+                    keys[key] = data
+    except tarfile.TarError as e:
+        raise ValueError(f"Could not read backup {archive_path}: {e}")
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    if metadata is None or metadata.get("version") != backup_version:
+        raise ValueError(f"Invalid backup {archive_path}")
+    return metadata, keys
+
+
+def backup_vault(vault_path, archive_path, vault_passphrase, passphrase, base=None):
+    """
+    Back up the keys in a vault to an encrypted archive.
+
+    If a base archive is given only keys whose content hash changed since the base
+    are written. The metadata always lists every key in the vault so that deleted
+    keys are known on restore. Full backups also save the LUKS header alongside
+    the archive. Returns the backup metadata.
+    """
+    # check for existing files before anything is written
+    header_path = f"{archive_path}.header"
+    for path in [archive_path] if base else [archive_path, header_path]:
+        if os.path.exists(path):
+            raise FileExistsError(f"{path} already exists.")
+
+    base_keys = {}
+    if base:
+        base_keys = read_backup(base, passphrase)[0]["keys"]
+
+    # read keys with the vault open for as short a time as possible
+    mnt = open_luks_vault(vault_path, vault_passphrase)
+    try:
+        keys = read_vault_keys(mnt)
+    finally:
+        close_luks_vault()
+
+    metadata = {
+        "version": backup_version,
+        "created": datetime.datetime.now().isoformat(),
+        "vault": os.path.basename(vault_path),
+        "base": os.path.basename(base) if base else None,
+        "keys": {
+            key: {"sha256": hash_ssh_key(data), "mode": mode}
+            for key, (data, mode) in keys.items()
+        },
+    }
+    changed = {
+        key: value
+        for key, value in keys.items()
+        if base_keys.get(key, {}).get("sha256") != metadata["keys"][key]["sha256"]
+    }
+    write_backup(archive_path, passphrase, metadata, changed)
+    if not base:
+        try:
+            backup_luks_header(vault_path, header_path)
+        except Exception:
+            # a full backup is not complete without its header
+            os.remove(archive_path)
+            raise
+    logging.info(f"Backed up {len(changed)} of {len(keys)} keys to {archive_path}")
+    return metadata
+
+
+def read_backup_chain(archive_paths, passphrase):
+    """
+    Read the keys of a backup chain.
+
+    Archives are applied in order, a full backup followed by its incremental
+    backups. Returns a dictionary of key to contents and permissions as of the
+    last archive.
+    """
+    metadata = None
+    contents = {}
+    previous = None
+    for archive_path in archive_paths:
+        metadata, keys = read_backup(archive_path, passphrase)
+        # each archive must be based on the archive before it
+        if metadata["base"] != previous:
+            expected = "a full backup" if previous is None else previous
+            raise ValueError(f"{archive_path} is not based on {expected}")
+        previous = os.path.basename(archive_path)
+        contents.update(keys)
+
+    # check every key in the latest state is available in the chain
+    keys = {}
+    for key, info in metadata["keys"].items():
+        data = contents.get(key)
+        if data is None or hash_ssh_key(data) != info["sha256"]:
+            raise ValueError(f"Key {key} is missing from the backup chain")
+        keys[key] = (data, info["mode"])
+    return keys
+
+
+def restore_vault(vault_path, keys, vault_passphrase, prune=False):
+    """
+    Write keys into a vault with the vault opened once.
+
+    Keys already in the vault which are not being restored are kept, unless prune
+    is set in which case they are deleted. Returns the list of deleted keys.
+    """
+    mnt = open_luks_vault(vault_path, vault_passphrase)
+    pruned = []
+    try:
+        for key, (data, mode) in keys.items():
+            write_ssh_key(data, os.path.join(mnt, key), mode)
+        if prune:
+            for key in get_ssh_key_list(mnt):
+                if key not in keys:
+                    delete_ssh_key(os.path.join(mnt, key))
+                    pruned.append(key)
+    finally:
+        close_luks_vault()
+    logging.info(f"Restored {len(keys)} keys to {vault_path}")
+    return pruned
@@ -4,14 +4,30 @@ import os
 
 import click
 
+from ssh_keyman.agent_utils import keep_loaded
+from ssh_keyman.backup_utils import backup_vault, read_backup_chain, restore_vault
 from ssh_keyman.keys_utils import (
-    copy_ssh_key,
     delete_ssh_key,
     get_ssh_key_list,
+    import_ssh_keys,
     load_ssh_key,
     unload_ssh_keys,
 )
-from ssh_keyman.luks_utils import close_luks_vault, create_luks_vault, open_luks_vault
+from ssh_keyman.luks_utils import (
+    close_luks_vault,
+    create_luks_vault,
+    open_luks_vault,
+    restore_luks_header,
+)
+from ssh_keyman.shard_utils import (
+    add_shard,
+    check_shard_group,
+    check_shard_passphrase,
+    close_shards,
+    open_shards,
+    rebalance_shards,
+)
+from ssh_keyman.watch_utils import watch_keys
 
 
 @click.group()
@@ -46,6 +62,13 @@ def create_vault(vault_path):
         logging.error(f"Error: {e}")
 
 
+def confirm_override(key):
+    """
+    Ask to confirm overriding a key already in the vault.
+    """
+    return click.confirm(f"Override existing key ({key})?")
+
+
 @ssh_keyman.command(name="add-keys")
 @click.argument("vault_path", type=click.Path(exists=True))
 @click.option(
@@ -65,20 +88,8 @@ def add_keys(vault_path, keys):
         passphrase = getpass.getpass("Enter vault passphrase: ")
         # open vault
         mnt = open_luks_vault(vault_path, passphrase)
-        existing_keys = get_ssh_key_list(mnt)
-        cnt = 0
-        for key in keys:
-            # check for existing key
-            if key in existing_keys:
-                if not click.confirm(f"Override existing key ({key})?"):
-                    # skip override
-                    logging.info("Key not added to vault")
-                    continue
-            # copy/override key
-            copy_ssh_key(key, mnt)
-            logging.info("Added key to vault")
-            cnt += 1
-        print(f"{cnt} keys added to vault")
+        imported = import_ssh_keys(mnt, keys, confirm_override)
+        print(f"{len(imported)} keys added to vault")
     except Exception as e:
         logging.error(f"Error: {e}")
     finally:
@@ -169,22 +180,266 @@ def remove_keys(vault_path):
             close_luks_vault()
 
 
+@ssh_keyman.command(name="create-shard")
+@click.argument("manifest_path", type=click.Path())
+@click.argument("group")
+@click.argument("vault_path", type=click.Path(exists=False))
+@click.option(
+    "-p",
+    "--pattern",
+    "patterns",
+    multiple=True,
+    help="Key name pattern belonging to the group (e.g. '*_prod_*').",
+)
+def create_shard(manifest_path, group, vault_path, patterns):
+    """
+    Create a LUKS shard vault for a key group and add it to a vault-group manifest.
+
+    All shards in a vault-group share the passphrase of the first shard.
+    """
+    try:
+        # check the group before formatting the vault
+        if check_shard_group(manifest_path, group)["groups"]:
+            # new shards use the passphrase of the existing shards
+            passphrase = getpass.getpass("Enter vault-group passphrase: ")
+            check_shard_passphrase(manifest_path, passphrase)
+        else:
+            passphrase = getpass.getpass("Enter a passphrase to secure the key vault: ")
+            if passphrase != getpass.getpass("Enter the passphrase again: "):
+                raise ValueError("Passphrases do not match.")
+        create_luks_vault(vault_path, 32, passphrase)
+        add_shard(manifest_path, group, vault_path, patterns or [f"*{group}*"])
+        logging.info(f"Shard for group {group} created at {vault_path}")
+    except Exception as e:
+        logging.error(f"Error: {e}")
+
+
 @ssh_keyman.command(name="load-keys")
 @click.argument("vault_path", type=click.Path(exists=True))
-def load_keys(vault_path):
+@click.option(
+    "-g",
+    "--group",
+    "groups",
+    multiple=True,
+    help="Load only this key group; VAULT_PATH is then a vault-group manifest.",
+)
+def load_keys(vault_path, groups):
     """
     Load SSH keys into the SSH-agent from the LUKS vault.
     """
     # prompt for passphrase
     passphrase = getpass.getpass("Enter vault passphrase: ")
-    mnt = open_luks_vault(vault_path, passphrase)
-    keys = get_ssh_key_list(mnt)
-    for key in keys:
-        load_ssh_key(key)
-    close_luks_vault()
+    if groups:
+        # unlock only the shards needed for the groups
+        mnts = open_shards(vault_path, groups, passphrase)
+        try:
+            for mnt in mnts.values():
+                for key in get_ssh_key_list(mnt):
+                    load_ssh_key(os.path.join(mnt, key))
+        finally:
+            close_shards(mnts)
+    else:
+        mnt = open_luks_vault(vault_path, passphrase)
+        keys = get_ssh_key_list(mnt)
+        for key in keys:
+            load_ssh_key(os.path.join(mnt, key))
+        close_luks_vault()
     print("Keys loaded")
 
 
+@ssh_keyman.command(name="rebalance")
+@click.argument("manifest_path", type=click.Path(exists=True))
+def rebalance(manifest_path):
+    """
+    Move keys between shards so each key lives in the shard of its group.
+    """
+    try:
+        # prompt for passphrase
+        passphrase = getpass.getpass("Enter vault passphrase: ")
+        moves = rebalance_shards(manifest_path, passphrase)
+        for key, src, dest in moves:
+            print(f"{key}: {src} -> {dest}")
+        print(f"{len(moves)} keys moved")
+    except Exception as e:
+        logging.error(f"Error: {e}")
+
+
+@ssh_keyman.command(name="backup")
+@click.argument("vault_path", type=click.Path(exists=True))
+@click.argument("archive_path", type=click.Path(exists=False))
+@click.option(
+    "-i",
+    "--incremental-from",
+    "base",
+    type=click.Path(exists=True),
+    help="Only back up keys changed since this backup archive.",
+)
+def backup(vault_path, archive_path, base):
+    """
+    Back up the keys in the LUKS vault to an encrypted archive.
+    """
+    try:
+        # prompt for passphrases
+        vault_passphrase = getpass.getpass("Enter vault passphrase: ")
+        passphrase = getpass.getpass("Enter backup passphrase: ")
+        if not base:
+            if passphrase != getpass.getpass("Enter the backup passphrase again: "):
+                raise ValueError("Passphrases do not match.")
+        metadata = backup_vault(
+            vault_path, archive_path, vault_passphrase, passphrase, base
+        )
+        print(f"{len(metadata['keys'])} keys backed up to {archive_path}")
+    except Exception as e:
+        logging.error(f"Error: {e}")
+
+
+@ssh_keyman.command(name="restore")
+@click.argument("vault_path", type=click.Path(exists=False))
+@click.argument("archive_paths", type=click.Path(exists=True), nargs=-1, required=True)
+@click.option(
+    "--header",
+    "header_path",
+    type=click.Path(exists=True),
+    help="Restore the LUKS header of an existing vault from this backup first.",
+)
+@click.option(
+    "--prune",
+    is_flag=True,
+    help="Delete keys in the vault which are not in the backup.",
+)
+def restore(vault_path, archive_paths, header_path, prune):
+    """
+    Restore keys from a full backup and its incremental backups into the LUKS vault.
+
+    The vault is created if it does not exist. Keys in the vault with the same name
+    as a backed up key are overwritten. Other keys already in the vault are kept
+    unless --prune is given.
+    """
+    try:
+        # read the backup chain before touching the vault
+        passphrase = getpass.getpass("Enter backup passphrase: ")
+        keys = read_backup_chain(archive_paths, passphrase)
+        if not os.path.exists(vault_path):
+            vault_passphrase = getpass.getpass(
+                "Enter a passphrase to secure the key vault: "
+            )
+            if vault_passphrase != getpass.getpass("Enter the passphrase again: "):
+                raise ValueError("Passphrases do not match.")
+            create_luks_vault(vault_path, 32, vault_passphrase)
+        else:
+            if header_path:
+                # a wrong header makes the vault unreadable
+                if not click.confirm(
+                    f"Overwrite the LUKS header of {vault_path} with {header_path}?"
+                ):
+                    print("No keys restored.")
+                    return
+                restore_luks_header(vault_path, header_path)
+            vault_passphrase = getpass.getpass("Enter vault passphrase: ")
+        if prune and not click.confirm(
+            "Delete keys in the vault which are not in the backup?"
+        ):
+            prune = False
+        pruned = restore_vault(vault_path, keys, vault_passphrase, prune)
+        print(f"{len(keys)} keys restored to vault")
+        if pruned:
+            print(f"{len(pruned)} keys not in the backup deleted from vault")
+    except Exception as e:
+        logging.error(f"Error: {e}")
+
+
+@ssh_keyman.command(name="watch")
+@click.argument("vault_path", type=click.Path(exists=True))
+@click.argument("watch_dir", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--overwrite/--no-overwrite",
+    default=None,
+    help="Override existing keys without asking, or never override them.",
+)
+@click.option(
+    "--remove",
+    is_flag=True,
+    help="Securely remove staged keys once they are added to the vault.",
+)
+@click.option(
+    "--debounce",
+    type=float,
+    default=2.0,
+    show_default=True,
+    help="Seconds without new keys before a batch is imported.",
+)
+@click.option(
+    "--max-wait",
+    type=float,
+    default=30.0,
+    show_default=True,
+    help="Maximum seconds a new key waits before its batch is imported.",
+)
+def watch(vault_path, watch_dir, overwrite, remove, debounce, max_wait):
+    """
+    Watch a directory and add new or changed SSH private keys to the LUKS vault.
+    """
+    confirm = confirm_override if overwrite is None else lambda key: overwrite
+    try:
+        # prompt for passphrase
+        passphrase = getpass.getpass("Enter vault passphrase: ")
+        watch_keys(
+            vault_path, watch_dir, passphrase, confirm, debounce, max_wait, remove
+        )
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    except Exception as e:
+        logging.error(f"Error: {e}")
+
+
+@ssh_keyman.command(name="keep-loaded")
+@click.argument("vault_path", type=click.Path(exists=True))
+@click.option(
+    "-t",
+    "--lifetime",
+    type=click.IntRange(min=1),
+    default=3600,
+    show_default=True,
+    help="Seconds each key stays in the SSH-agent.",
+)
+@click.option(
+    "-w",
+    "--window",
+    type=click.IntRange(min=0),
+    default=300,
+    show_default=True,
+    help="Re-add keys expiring within this many seconds.",
+)
+@click.option(
+    "--interval",
+    type=click.IntRange(min=1),
+    default=60,
+    show_default=True,
+    help="Seconds between checks of the SSH-agent for missing keys.",
+)
+@click.option(
+    "-s",
+    "--status-socket",
+    "socket_path",
+    type=click.Path(),
+    help="Unix socket serving the refresh status as JSON.",
+)
+def keep_loaded_keys(vault_path, lifetime, window, interval, socket_path):
+    """
+    Keep SSH keys from the LUKS vault loaded in the SSH-agent with a limited lifetime.
+    """
+    try:
+        if window >= lifetime:
+            raise ValueError("Refresh window must be shorter than the key lifetime.")
+        # prompt for passphrase
+        passphrase = getpass.getpass("Enter vault passphrase: ")
+        keep_loaded(vault_path, passphrase, lifetime, window, interval, socket_path)
+    except KeyboardInterrupt:
+        print("Stopped keeping keys loaded")
+    except Exception as e:
+        logging.error(f"Error: {e}")
+
+
 @ssh_keyman.command(name="unload-keys")
 def unload_keys():
     """
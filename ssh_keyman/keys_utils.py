@@ -37,11 +37,91 @@ def get_ssh_key_list(mnt):
     keys = []
     for file in os.listdir(mnt):
         # check for file
-        if os.path.isfile(file):
+        if os.path.isfile(os.path.join(mnt, file)):
             keys.append(file)
     return keys
 
 
+def write_ssh_key(data, dest, mode=0o600):
+    """
+    Write SSH key contents to destination owned by the current user.
+    """
+    try:
+        # write key from stdin with ownership and permissions
+        cmd = [
+            "sudo",
+            "install",
+            "-m",
+            f"{mode:o}",
+            "-o",
+            str(os.getuid()),
+            "-g",
+            str(os.getgid()),
+            "/dev/stdin",
+            dest,
+        ]
+        subprocess.run(cmd, input=data, check=True)
+        logging.debug(f"SSH key written to {dest}")
+
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error: Command failed with code {e.returncode}")
+        raise
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        raise
+
+
+def import_ssh_keys(mnt, keys, confirm):
+    """
+    Copy SSH keys to mount point, asking to confirm before overriding existing keys.
+
+    Returns the list of keys copied.
+    """
+    existing_keys = get_ssh_key_list(mnt)
+    imported = []
+    for key in keys:
+        # check for existing key
+        if os.path.basename(key) in existing_keys:
+            if not confirm(key):
+                # skip override
+                logging.info("Key not added to vault")
+                continue
+        # copy/override key
+        copy_ssh_key(key, mnt)
+        logging.info("Added key to vault")
+        imported.append(key)
+    return imported
+
+
+def is_ssh_private_key(path):
+    """
+    Check if the file at path is an SSH private key.
+    """
+    try:
+        with open(path, "rb") as f:
+            line = f.readline(128)
+    except OSError:
+        return False
+    return line.startswith(b"-----BEGIN ") and b"PRIVATE KEY-----" in line
+
+
+def shred_ssh_key(path):
+    """
+    Securely remove key at path
+    """
+    try:
+        # overwrite before unlinking
+        cmd = ["shred", "-u", path]
+        subprocess.run(cmd, check=True)
+        logging.debug(f"Shredded SSH key {path}")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error: Command failed with code {e.returncode}")
+        raise
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        raise
+
+
 def delete_ssh_key(path):
     """
     Delete key at path
@@ -60,16 +140,19 @@ def delete_ssh_key(path):
         raise
 
 
-def load_ssh_key(key_path):
+def load_ssh_key(key_path, lifetime=None):
     """
-    Loads key into SSH-agent.
+    Loads key into SSH-agent, optionally for a limited lifetime in seconds.
     """
     try:
         # check if ssh socket is open
         get_ssh_socket()
 
         # add keys to agent
-        cmd = ["ssh-add", key_path]
+        cmd = ["ssh-add"]
+        if lifetime is not None:
+            cmd += ["-t", str(lifetime)]
+        cmd.append(key_path)
         subprocess.run(cmd, check=True)
         logging.debug(f"Key {key_path} added to ssh-agent")
     except subprocess.CalledProcessError as e:
@@ -98,3 +181,43 @@ def unload_ssh_keys():
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
         raise
+
+
+def get_ssh_key_fingerprint(key_path):
+    """
+    Get the fingerprint of an SSH key.
+    """
+    try:
+        cmd = ["ssh-keygen", "-l", "-f", key_path]
+        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        return result.stdout.split()[1]
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error: Command failed with code {e.returncode}")
+        raise
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        raise
+
+
+def get_agent_fingerprints():
+    """
+    Get the fingerprints of keys loaded in SSH-agent.
+    """
+    try:
+        # check if socket is open
+        get_ssh_socket()
+
+        # list keys in agent, exit code 1 means the agent has no keys
+        cmd = ["ssh-add", "-l"]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode == 1:
+            return set()
+        if result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, cmd)
+        return {line.split()[1] for line in result.stdout.splitlines() if line}
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error: Command failed with code {e.returncode}")
+        raise
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        raise
@@ -33,6 +33,41 @@ def close_luks_container(dev):
     logging.debug(f"Closed LUKS device {dev}.")
 
 
+def backup_luks_header(vault_path, header_path):
+    """
+    Save a backup of a LUKS container header.
+    """
+    cmd = [
+        "sudo",
+        "cryptsetup",
+        "luksHeaderBackup",
+        vault_path,
+        "--header-backup-file",
+        header_path,
+    ]
+    subprocess.run(cmd, check=True)
+    logging.debug(f"Saved LUKS header of {vault_path} to {header_path}.")
+
+
+def restore_luks_header(vault_path, header_path):
+    """
+    Restore a LUKS container header from a backup.
+
+    cryptsetup asks for confirmation itself and checks the header matches the
+    container.
+    """
+    cmd = [
+        "sudo",
+        "cryptsetup",
+        "luksHeaderRestore",
+        vault_path,
+        "--header-backup-file",
+        header_path,
+    ]
+    subprocess.run(cmd, check=True)
+    logging.debug(f"Restored LUKS header of {vault_path} from {header_path}.")
+
+
 def mkfs_luks_dev(dev):
     """
     Format a LUKS block device with an EXT4 filesystem.
@@ -42,9 +77,9 @@ def mkfs_luks_dev(dev):
     logging.debug(f"Created ext4 filesystem on /dev/mapper/{dev}.")
 
 
-def create_luks_vault(vault_path, size_MB):
+def create_luks_vault(vault_path, size_MB, passphrase=None):
     """
-    Create a LUKS file vault.
+    Create a LUKS file vault, prompting for a passphrase if none is given.
     """
     vault_created = False
     vault_is_open = False
@@ -54,10 +89,11 @@ def create_luks_vault(vault_path, size_MB):
             raise FileExistsError(f"{vault_path} already exists.")
 
         # prompt for passphrase
-        passphrase = getpass.getpass("Enter a passphrase to secure the key vault: ")
-        confirm_passphrase = getpass.getpass("Enter the passphrase again: ")
-        if passphrase != confirm_passphrase:
-            raise ValueError("Passphrases do not match.")
+        if passphrase is None:
+            passphrase = getpass.getpass("Enter a passphrase to secure the key vault: ")
+            confirm_passphrase = getpass.getpass("Enter the passphrase again: ")
+            if passphrase != confirm_passphrase:
+                raise ValueError("Passphrases do not match.")
 
         # create empty file
         with open(vault_path, "xb") as f:
@@ -97,71 +133,71 @@ def create_luks_vault(vault_path, size_MB):
             close_luks_container(ssh_keyman_dev)
 
 
-def open_luks_vault(vault_path, passphrase):
+def open_luks_vault(vault_path, passphrase, dev=ssh_keyman_dev, mnt=ssh_keyman_mnt):
     """
     Open a LUKS file vault and mount it
     """
     vault_is_open = False
     try:
         # open LUKS container
-        open_luks_container(passphrase, vault_path, ssh_keyman_dev)
+        open_luks_container(passphrase, vault_path, dev)
         vault_is_open = True
 
         # check for mount point
-        if os.path.isdir(ssh_keyman_mnt):
-            if len(os.listdir(ssh_keyman_mnt)):
-                raise PermissionError(f"Mount point is not empty {ssh_keyman_mnt}")
+        if os.path.isdir(mnt):
+            if len(os.listdir(mnt)):
+                raise PermissionError(f"Mount point is not empty {mnt}")
         else:
-            cmd = ["sudo", "mkdir", ssh_keyman_mnt]
+            cmd = ["sudo", "mkdir", mnt]
             subprocess.run(cmd, check=True)
-            logging.debug(f"Created mount point at {ssh_keyman_mnt}")
+            logging.debug(f"Created mount point at {mnt}")
 
         # check if mount point is in use
-        if os.path.ismount(ssh_keyman_mnt):
-            raise PermissionError(f"Mount point already in use {ssh_keyman_mnt}")
+        if os.path.ismount(mnt):
+            raise PermissionError(f"Mount point already in use {mnt}")
 
         # mount to mount point
-        cmd = ["sudo", "mount", f"/dev/mapper/{ssh_keyman_dev}", ssh_keyman_mnt]
+        cmd = ["sudo", "mount", f"/dev/mapper/{dev}", mnt]
         subprocess.run(cmd, check=True)
-        logging.debug(f"Mounted /dev/mapper/{ssh_keyman_dev} at {ssh_keyman_mnt}")
+        logging.debug(f"Mounted /dev/mapper/{dev} at {mnt}")
 
-        return ssh_keyman_mnt
+        return mnt
 
     except subprocess.CalledProcessError as e:
         logging.error(f"Error: Command failed with code {e.returncode}.")
         if vault_is_open:
             # close the vault
-            close_luks_container(ssh_keyman_dev)
+            close_luks_container(dev)
         raise
 
     except Exception as e:
         print(f"Error: {e}")
         if vault_is_open:
             # close the vault
-            close_luks_container(ssh_keyman_dev)
+            close_luks_container(dev)
         raise
 
 
-def close_luks_vault():
+def close_luks_vault(dev=ssh_keyman_dev, mnt=ssh_keyman_mnt):
     """
     Close a LUKS file vault
     """
     try:
         # unmount
-        if os.path.ismount(ssh_keyman_mnt):
-            cmd = ["sudo", "umount", ssh_keyman_mnt]
+        if os.path.ismount(mnt):
+            cmd = ["sudo", "umount", mnt]
             subprocess.run(cmd, check=True)
-            logging.debug(f"Unmounted {ssh_keyman_mnt}")
+            logging.debug(f"Unmounted {mnt}")
         else:
             logging.warning("Unmount unsuccessful, mount point not in use")
 
         # remove mount point
-        cmd = ["sudo", "rmdir", ssh_keyman_mnt]
+        cmd = ["sudo", "rmdir", mnt]
         subprocess.run(cmd, check=True)
-        logging.debug(f"Removed mount point at {ssh_keyman_mnt}")
+        logging.debug(f"Removed mount point at {mnt}")
 
         # close vault
-        close_luks_container(ssh_keyman_dev)
+        close_luks_container(dev)
 
     except subprocess.CalledProcessError as e:
         logging.error(f"Error: Command failed with code {e.returncode}.")
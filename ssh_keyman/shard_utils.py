@@ -0,0 +1,196 @@
+import fnmatch
+import json
+import logging
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from ssh_keyman.keys_utils import copy_ssh_key, delete_ssh_key, get_ssh_key_list
+from ssh_keyman.luks_utils import (
+    close_luks_vault,
+    open_luks_vault,
+    ssh_keyman_dev,
+    ssh_keyman_mnt,
+)
+
+group_name_re = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def read_shard_manifest(manifest_path):
+    """
+    Read a vault-group manifest.
+    """
+    if not os.path.exists(manifest_path):
+        return {"groups": {}}
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if not isinstance(manifest.get("groups"), dict):
+        raise ValueError(f"Invalid vault-group manifest {manifest_path}")
+    return manifest
+
+
+def write_shard_manifest(manifest_path, manifest):
+    """
+    Write a vault-group manifest.
+    """
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    logging.debug(f"Wrote vault-group manifest to {manifest_path}")
+
+
+def check_shard_group(manifest_path, group):
+    """
+    Check a group name is valid and not yet in the manifest.
+    """
+    if not group_name_re.match(group):
+        raise ValueError(f"Invalid group name {group}")
+    manifest = read_shard_manifest(manifest_path)
+    if group in manifest["groups"]:
+        raise ValueError(f"Group {group} already exists in {manifest_path}")
+    return manifest
+
+
+def add_shard(manifest_path, group, vault_path, patterns):
+    """
+    Register a shard vault for a key group in the manifest.
+    """
+    manifest = check_shard_group(manifest_path, group)
+    # store vault paths relative to the manifest
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    manifest["groups"][group] = {
+        "vault": os.path.relpath(os.path.abspath(vault_path), base),
+        "patterns": list(patterns),
+    }
+    write_shard_manifest(manifest_path, manifest)
+    logging.debug(f"Added shard {vault_path} for group {group}")
+
+
+def get_shard_vault(manifest_path, manifest, group):
+    """
+    Get the path of the shard vault for a group.
+    """
+    if group not in manifest["groups"]:
+        raise KeyError(f"Group {group} not found in {manifest_path}")
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    return os.path.join(base, manifest["groups"][group]["vault"])
+
+
+def get_shard_dev(group):
+    """
+    Get the device name and mount point used for a group's shard.
+    """
+    return f"{ssh_keyman_dev}_{group}", f"{ssh_keyman_mnt}_{group}"
+
+
+def get_key_group(manifest, key):
+    """
+    Get the group whose patterns match a key name, or None.
+    """
+    for group, shard in manifest["groups"].items():
+        for pattern in shard["patterns"]:
+            if fnmatch.fnmatch(key, pattern):
+                return group
+    return None
+
+
+def close_shards(groups):
+    """
+    Unmount and close the shards for the given groups concurrently.
+    """
+    groups = list(groups)
+    if not groups:
+        return
+
+    def close_shard(group):
+        close_luks_vault(*get_shard_dev(group))
+
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        # consume results so errors are raised
+        list(executor.map(close_shard, groups))
+
+
+def open_shards(manifest_path, groups, passphrase):
+    """
+    Unlock and mount the shards for the given groups concurrently.
+
+    All shards in a vault-group share one passphrase. Returns a dictionary of
+    group to mount point. If any shard fails to open, the shards which did open
+    are closed again before the error is raised.
+    """
+    manifest = read_shard_manifest(manifest_path)
+    vaults = {
+        group: get_shard_vault(manifest_path, manifest, group) for group in groups
+    }
+
+    def open_shard(group):
+        dev, mnt = get_shard_dev(group)
+        return open_luks_vault(vaults[group], passphrase, dev, mnt)
+
+    groups = list(vaults)
+    if not groups:
+        return {}
+    # open the first shard on its own so sudo prompts at most once, and a wrong
+    # passphrase fails before the other shards are tried
+    mnts = {groups[0]: open_shard(groups[0])}
+    logging.debug(f"Opened shard for group {groups[0]}")
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(len(groups) - 1, 1)) as executor:
+        futures = {group: executor.submit(open_shard, group) for group in groups[1:]}
+        for group, future in futures.items():
+            try:
+                mnts[group] = future.result()
+                logging.debug(f"Opened shard for group {group}")
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        close_shards(mnts)
+        raise errors[0]
+    return mnts
+
+
+def check_shard_passphrase(manifest_path, passphrase):
+    """
+    Check the passphrase unlocks the existing shards of a vault-group.
+    """
+    groups = list(read_shard_manifest(manifest_path)["groups"])
+    if not groups:
+        return
+    try:
+        mnts = open_shards(manifest_path, groups[:1], passphrase)
+    except subprocess.CalledProcessError:
+        raise ValueError(f"Passphrase does not unlock the shards in {manifest_path}")
+    close_shards(mnts)
+
+
+def rebalance_shards(manifest_path, passphrase):
+    """
+    Move keys into the shard whose group patterns match them.
+
+    Keys which do not match any group are left in place. Returns a list of
+    (key, source group, destination group) moves.
+    """
+    manifest = read_shard_manifest(manifest_path)
+    moves = []
+    mnts = open_shards(manifest_path, manifest["groups"], passphrase)
+    try:
+        for group, mnt in mnts.items():
+            for key in get_ssh_key_list(mnt):
+                target = get_key_group(manifest, key)
+                if target is None or target == group:
+                    continue
+                # copy to destination shard before removing from source
+                src = os.path.join(mnt, key)
+                if key in get_ssh_key_list(mnts[target]):
+                    logging.warning(
+                        f"Key {key} already exists in group {target}, not moved"
+                    )
+                    continue
+                copy_ssh_key(src, mnts[target])
+                delete_ssh_key(src)
+                logging.info(f"Moved key {key} from group {group} to {target}")
+                moves.append((key, group, target))
+    finally:
+        close_shards(mnts)
+    return moves
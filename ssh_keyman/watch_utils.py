@@ -0,0 +1,138 @@
+import logging
+import os
+import select
+import subprocess
+import time
+
+from ssh_keyman.keys_utils import import_ssh_keys, is_ssh_private_key, shred_ssh_key
+from ssh_keyman.luks_utils import close_luks_vault, open_luks_vault
+
+
+def inotify_cmd(watch_dir):
+    """
+    Build the inotifywait command reporting files written or moved into a directory.
+    """
+    return [
+        "inotifywait",
+        "--monitor",
+        "--quiet",
+        "--event",
+        "close_write,moved_to",
+        "--format",
+        "%w%f",
+        watch_dir,
+    ]
+
+
+def batch_key_events(fd, debounce, max_wait, idle=None):
+    """
+    Group file paths read line by line from fd into debounced batches.
+
+    A batch is yielded once no new path has arrived for debounce seconds, or once
+    the oldest path in the batch has waited max_wait seconds. Yields lists of
+    unique paths in the order they were first seen, until fd is closed. If idle
+    is given, an empty batch is yielded after idle seconds without any path.
+    """
+    buf = b""
+    pending = {}
+    first = last = None
+    while True:
+        timeout = idle
+        if pending:
+            deadline = min(last + debounce, first + max_wait)
+            timeout = max(deadline - time.monotonic(), 0)
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if not ready:
+            # quiet period elapsed, or idle with nothing pending
+            yield list(pending)
+            pending = {}
+            continue
+
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            # end of stream
+            if pending:
+                yield list(pending)
+            return
+        *lines, buf = (buf + chunk).split(b"\n")
+        now = time.monotonic()
+        for line in lines:
+            if not line:
+                continue
+            if not pending:
+                first = now
+            pending[os.fsdecode(line)] = None
+            last = now
+
+
+def import_key_batch(vault_path, passphrase, paths, confirm, remove=False):
+    """
+    Import the private keys in a batch of paths with the vault opened once.
+
+    Returns the list of keys imported.
+    """
+    keys = [path for path in paths if is_ssh_private_key(path)]
+    if not keys:
+        return []
+
+    mnt = open_luks_vault(vault_path, passphrase)
+    try:
+        imported = import_ssh_keys(mnt, keys, confirm)
+    finally:
+        close_luks_vault()
+
+    if remove:
+        # remove staged originals only once they are safely in the vault
+        for key in imported:
+            shred_ssh_key(key)
+    return imported
+
+
+def watch_keys(
+    vault_path,
+    watch_dir,
+    passphrase,
+    confirm,
+    debounce=2.0,
+    max_wait=30.0,
+    remove=False,
+):
+    """
+    Import private keys written to a directory into the vault in debounced batches.
+
+    Runs until inotifywait exits or the watch is interrupted. Batches which fail
+    to import are logged and their files are retried with the next batch, or after
+    max_wait seconds if no new files arrive.
+    """
+    # check the passphrase before waiting for keys
+    open_luks_vault(vault_path, passphrase)
+    close_luks_vault()
+
+    cmd = inotify_cmd(watch_dir)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    logging.debug(f"Watching {watch_dir} for new keys")
+    failed = []
+    try:
+        fd = proc.stdout.fileno()
+        for paths in batch_key_events(fd, debounce, max_wait, idle=max_wait):
+            if not paths and not failed:
+                continue
+            logging.debug(f"Received batch of {len(paths)} files")
+            paths = list(dict.fromkeys(failed + paths))
+            try:
+                imported = import_key_batch(
+                    vault_path, passphrase, paths, confirm, remove
+                )
+            except Exception as e:
+                # retry with the next batch
+                logging.error(f"Error: {e}")
+                failed = paths
+                continue
+            failed = []
+            if imported:
+                print(f"{len(imported)} keys added to vault")
+    finally:
+        proc.terminate()
+        proc.wait()
+    if proc.returncode not in (0, -15):
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
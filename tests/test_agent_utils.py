@@ -0,0 +1,226 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from ssh_keyman.agent_utils import (
+    get_due_keys,
+    get_refresh_delay,
+    get_refresh_expiry,
+    keep_loaded,
+    new_refresh_state,
+    refresh_keys,
+    start_status_server,
+)
+from ssh_keyman.keys_utils import load_ssh_key
+
+
+def make_state(expires):
+    state = new_refresh_state(3600)
+    state["keys"] = {
+        key: {"fingerprint": f"SHA256:{key}", "expires": value, "refreshes": 0}
+        for key, value in expires.items()
+    }
+    return state
+
+
+class TestAgentUtils:
+
+    def test_get_due_keys(self):
+        """Keys within the refresh window or missing from the agent are due."""
+        state = make_state({"id_a": 1100, "id_b": 1250, "id_c": 2000, "id_d": 3000})
+        agent = {"SHA256:id_a", "SHA256:id_b", "SHA256:id_c"}
+        # run
+        due = get_due_keys(state, 1000, 300, agent)
+        # assert
+        assert due == ["id_a", "id_b", "id_d"]
+
+    def test_get_refresh_delay(self):
+        """The next check is in time for the first key to enter the window."""
+        state = make_state({"id_a": 1400, "id_b": 2000})
+        assert get_refresh_delay(state, 1000, 300, 600) == 100
+        assert get_refresh_delay(state, 1000, 300, 60) == 60
+        assert get_refresh_delay(state, 1200, 300, 60) == 1
+        assert get_refresh_delay(new_refresh_state(3600), 1000, 300, 60) == 60
+
+    def test_refresh_keys(self, mocker):
+        """Only due and new keys are added, with the vault opened once."""
+        # mock
+        mocker.patch("time.time", return_value=1000)
+        state = make_state({"id_a": 1100, "id_b": 4000})
+        mock_open_vault = mocker.patch(
+            "ssh_keyman.agent_utils.open_luks_vault", return_value="/mnt/test"
+        )
+        mock_close_vault = mocker.patch("ssh_keyman.agent_utils.close_luks_vault")
+        mocker.patch(
+            "ssh_keyman.agent_utils.get_ssh_key_list",
+            return_value=["id_a", "id_b", "id_new"],
+        )
+        mocker.patch(
+            "ssh_keyman.agent_utils.get_ssh_key_fingerprint",
+            side_effect=lambda path: f"SHA256:{path.rsplit('/', 1)[1]}",
+        )
+        mock_load_key = mocker.patch("ssh_keyman.agent_utils.load_ssh_key")
+        # run
+        added = refresh_keys(
+            "vault.luks", "password", state, ["id_a"], threading.Lock()
+        )
+        # assert
+        assert added == ["id_a", "id_new"]
+        mock_open_vault.assert_called_once_with("vault.luks", "password")
+        mock_close_vault.assert_called_once()
+        assert mock_load_key.call_args_list == [
+            mocker.call("/mnt/test/id_a", 3600),
+            mocker.call("/mnt/test/id_new", 3600),
+        ]
+        assert state["keys"]["id_a"]["expires"] == 4600
+        assert state["keys"]["id_a"]["refreshes"] == 1
+        assert state["keys"]["id_b"]["expires"] == 4000
+        assert state["keys"]["id_new"]["refreshes"] == 0
+        assert state["refreshes"] == 1
+        assert state["unlocks"]["count"] == 1
+
+    def test_status_server(self, tmp_path):
+        """The status socket serves the refresh state as JSON."""
+        socket_path = str(tmp_path / "status.sock")
+        state = make_state({"id_a": 4102444800})
+        server = start_status_server(socket_path, state, threading.Lock())
+        try:
+            # run
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(socket_path)
+                data = client.makefile("rb").read()
+        finally:
+            server.shutdown()
+            server.server_close()
+        # assert
+        status = json.loads(data)
+        assert status["lifetime"] == 3600
+        assert status["keys"]["id_a"]["fingerprint"] == "SHA256:id_a"
+        assert status["keys"]["id_a"]["expires_in"] > 0
+        assert (tmp_path / "status.sock").stat().st_mode & 0o777 == 0o600
+
+    def test_status_server_existing_file(self, tmp_path):
+        """Exception flow of start_status_server when the path is a regular file."""
+        path = tmp_path / "status.txt"
+        path.write_text("keep me")
+        # run
+        with pytest.raises(FileExistsError):
+            start_status_server(str(path), new_refresh_state(3600), threading.Lock())
+        # assert
+        assert path.read_text() == "keep me"
+
+    def test_status_server_stale_socket(self, tmp_path):
+        """A socket nothing listens on is replaced, a live one is not."""
+        socket_path = str(tmp_path / "status.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(socket_path)
+        stale.close()
+        # run
+        server = start_status_server(
+            socket_path, new_refresh_state(3600), threading.Lock()
+        )
+        try:
+            with pytest.raises(FileExistsError):
+                start_status_server(
+                    socket_path, new_refresh_state(3600), threading.Lock()
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_get_refresh_expiry(self):
+        """Keys refreshed out of cycle expire with the keys which are not due."""
+        state = make_state({"id_a": 1000, "id_b": 3000, "id_c": 3200})
+        assert get_refresh_expiry(state, ["id_a"], 1000, 360) == 3000
+        assert get_refresh_expiry(state, ["id_a"], 2700, 360) is None
+        assert get_refresh_expiry(state, ["id_a", "id_b", "id_c"], 1000, 360) is None
+
+    def test_refresh_missing_key(self, mocker):
+        """A missing key is re-added to expire together with the other keys."""
+        # mock
+        mocker.patch("time.time", return_value=1000)
+        state = make_state({"id_a": 3000, "id_b": 3000})
+        mocker.patch("ssh_keyman.agent_utils.open_luks_vault", return_value="/mnt")
+        mocker.patch("ssh_keyman.agent_utils.close_luks_vault")
+        mocker.patch(
+            "ssh_keyman.agent_utils.get_ssh_key_list", return_value=["id_a", "id_b"]
+        )
+        mocker.patch(
+            "ssh_keyman.agent_utils.get_ssh_key_fingerprint",
+            side_effect=lambda path: f"SHA256:{path.rsplit('/', 1)[1]}",
+        )
+        mock_load_key = mocker.patch("ssh_keyman.agent_utils.load_ssh_key")
+        due = get_due_keys(state, 1000, 360, {"SHA256:id_b"})
+        # run
+        expires = get_refresh_expiry(state, due, 1000, 360)
+        refresh_keys("vault.luks", "password", state, due, threading.Lock(), expires)
+        # assert
+        assert due == ["id_a"]
+        mock_load_key.assert_called_once_with("/mnt/id_a", 2000)
+        assert state["keys"]["id_a"]["expires"] == state["keys"]["id_b"]["expires"]
+        assert get_due_keys(state, 2700, 360, {"SHA256:id_a", "SHA256:id_b"}) == [
+            "id_a",
+            "id_b",
+        ]
+
+    def test_refresh_keys_slow_unlock(self, mocker):
+        """Keys get the full lifetime if the aligned expiry passed during unlock."""
+        # mock
+        mocker.patch("time.time", return_value=1002)
+        state = make_state({"id_a": 900})
+        mocker.patch("ssh_keyman.agent_utils.open_luks_vault", return_value="/mnt")
+        mocker.patch("ssh_keyman.agent_utils.close_luks_vault")
+        mocker.patch("ssh_keyman.agent_utils.get_ssh_key_list", return_value=["id_a"])
+        mocker.patch(
+            "ssh_keyman.agent_utils.get_ssh_key_fingerprint", return_value="SHA256:a"
+        )
+        mock_load_key = mocker.patch("ssh_keyman.agent_utils.load_ssh_key")
+        # run
+        refresh_keys(
+            "vault.luks", "password", state, ["id_a"], threading.Lock(), 1001.5, 0
+        )
+        # assert
+        mock_load_key.assert_called_once_with("/mnt/id_a", 3600)
+        assert state["keys"]["id_a"]["expires"] == 4602
+
+    def test_load_ssh_key_lifetime(self, mocker):
+        """A lifetime of 0 is passed to ssh-add and not dropped."""
+        # mock
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/tmp/agent.sock"})
+        mock_subprocess = mocker.patch("subprocess.run")
+        # run
+        load_ssh_key("/mnt/id_a", 0)
+        # assert
+        mock_subprocess.assert_called_once_with(
+            ["ssh-add", "-t", "0", "/mnt/id_a"], check=True
+        )
+
+    def test_keep_loaded_failed_refresh(self, mocker):
+        """A failing refresh is retried after interval seconds, not every second."""
+
+        # mock
+        def refresh(vault_path, passphrase, state, due, lock, *args):
+            if state["refreshes"]:
+                raise PermissionError("Mount point already in use")
+            state["keys"] = make_state({"id_a": 1000})["keys"]
+            state["refreshes"] += 1
+
+        mocker.patch("time.time", return_value=1000)
+        mocker.patch("ssh_keyman.agent_utils.refresh_keys", side_effect=refresh)
+        mocker.patch(
+            "ssh_keyman.agent_utils.get_agent_fingerprints", return_value=set()
+        )
+        mock_sleep = mocker.patch(
+            "time.sleep", side_effect=[None, None, KeyboardInterrupt]
+        )
+        # run
+        with pytest.raises(KeyboardInterrupt):
+            keep_loaded("vault.luks", "password", 3600, 300, interval=60)
+        # assert
+        assert mock_sleep.call_args_list == [
+            mocker.call(1),
+            mocker.call(60),
+            mocker.call(60),
+        ]
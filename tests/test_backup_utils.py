@@ -0,0 +1,134 @@
+import pytest
+
+from ssh_keyman.backup_utils import (
+    backup_vault,
+    read_backup,
+    read_backup_chain,
+    restore_vault,
+    write_backup,
+)
+
+
+@pytest.fixture
+def vault_mnt(tmp_path, mocker):
+    mnt = tmp_path / "mnt"
+    mnt.mkdir()
+    (mnt / "id_web").write_bytes(b"web key")
+    (mnt / "id_db").write_bytes(b"db key")
+    mocker.patch("ssh_keyman.backup_utils.open_luks_vault", return_value=str(mnt))
+    mocker.patch("ssh_keyman.backup_utils.close_luks_vault")
+    return mnt
+
+
+class TestBackupUtils:
+
+    def test_write_read_backup(self, tmp_path):
+        """Backups read back the metadata and keys written."""
+        archive = str(tmp_path / "backup.enc")
+        metadata = {"version": 1, "keys": {}}
+        # run
+        write_backup(archive, "password", metadata, {"id_web": (b"web key", 0o600)})
+        # assert
+        assert b"web key" not in (tmp_path / "backup.enc").read_bytes()
+        assert read_backup(archive, "password") == (metadata, {"id_web": b"web key"})
+
+    def test_read_backup_wrong_passphrase(self, tmp_path):
+        """Exception flow of read_backup with the wrong passphrase."""
+        archive = str(tmp_path / "backup.enc")
+        write_backup(archive, "password", {"version": 1, "keys": {}}, {})
+        with pytest.raises(ValueError):
+            read_backup(archive, "wrong")
+
+    def test_backup_vault_incremental(self, tmp_path, vault_mnt, mocker):
+        """Incremental backups only contain changed keys."""
+        # mock
+        mock_header = mocker.patch("ssh_keyman.backup_utils.backup_luks_header")
+        full = str(tmp_path / "full.enc")
+        incremental = str(tmp_path / "incremental.enc")
+        # run
+        backup_vault("vault.luks", full, "vault", "password")
+        (vault_mnt / "id_db").write_bytes(b"new db key")
+        (vault_mnt / "id_web").unlink()
+        backup_vault("vault.luks", incremental, "vault", "password", base=full)
+        # assert
+        mock_header.assert_called_once_with("vault.luks", f"{full}.header")
+        assert read_backup(full, "password")[1] == {
+            "id_web": b"web key",
+            "id_db": b"db key",
+        }
+        metadata, keys = read_backup(incremental, "password")
+        assert metadata["base"] == "full.enc"
+        assert list(metadata["keys"]) == ["id_db"]
+        assert keys == {"id_db": b"new db key"}
+        mode = (vault_mnt / "id_db").stat().st_mode & 0o777
+        assert read_backup_chain([full, incremental], "password") == {
+            "id_db": (b"new db key", mode)
+        }
+
+    def test_read_backup_chain_missing_key(self, tmp_path, vault_mnt, mocker):
+        """Exception flow of read_backup_chain without the full backup."""
+        mocker.patch("ssh_keyman.backup_utils.backup_luks_header")
+        full = str(tmp_path / "full.enc")
+        incremental = str(tmp_path / "incremental.enc")
+        backup_vault("vault.luks", full, "vault", "password")
+        backup_vault("vault.luks", incremental, "vault", "password", base=full)
+        with pytest.raises(ValueError):
+            read_backup_chain([incremental], "password")
+
+    def test_read_backup_chain_out_of_order(self, tmp_path, vault_mnt, mocker):
+        """Exception flow of read_backup_chain with archives out of order."""
+        mocker.patch("ssh_keyman.backup_utils.backup_luks_header")
+        full = str(tmp_path / "full.enc")
+        inc1 = str(tmp_path / "inc1.enc")
+        inc2 = str(tmp_path / "inc2.enc")
+        backup_vault("vault.luks", full, "vault", "password")
+        (vault_mnt / "id_db").write_bytes(b"db key 1")
+        backup_vault("vault.luks", inc1, "vault", "password", base=full)
+        (vault_mnt / "id_db").write_bytes(b"db key 2")
+        backup_vault("vault.luks", inc2, "vault", "password", base=inc1)
+        # assert
+        assert read_backup_chain([full, inc1, inc2], "password")["id_db"][0] == (
+            b"db key 2"
+        )
+        with pytest.raises(ValueError):
+            read_backup_chain([full, inc2, inc1], "password")
+        with pytest.raises(ValueError):
+            read_backup_chain([inc1, inc2], "password")
+
+    def test_write_backup_failure(self, tmp_path, mocker):
+        """A failed backup does not leave an archive behind."""
+        archive = str(tmp_path / "backup.enc")
+        # mock
+        mocker.patch("subprocess.Popen", side_effect=FileNotFoundError("openssl"))
+        # run
+        with pytest.raises(FileNotFoundError):
+            write_backup(archive, "password", {"version": 1, "keys": {}}, {})
+        # assert
+        assert not (tmp_path / "backup.enc").exists()
+
+    def test_backup_vault_header_exists(self, tmp_path, vault_mnt, mocker):
+        """Exception flow of backup_vault when the header backup already exists."""
+        # mock
+        mock_header = mocker.patch("ssh_keyman.backup_utils.backup_luks_header")
+        (tmp_path / "full.enc.header").write_bytes(b"")
+        # run
+        with pytest.raises(FileExistsError):
+            backup_vault("vault.luks", str(tmp_path / "full.enc"), "vault", "password")
+        # assert
+        assert not (tmp_path / "full.enc").exists()
+        mock_header.assert_not_called()
+
+    def test_restore_vault_prune(self, vault_mnt, mocker):
+        """Keys not in the backup are only deleted when pruning."""
+        # mock
+        mock_write = mocker.patch("ssh_keyman.backup_utils.write_ssh_key")
+        mock_delete = mocker.patch("ssh_keyman.backup_utils.delete_ssh_key")
+        keys = {"id_web": (b"web key", 0o600)}
+        # run
+        assert restore_vault("vault.luks", keys, "vault") == []
+        mock_delete.assert_not_called()
+        pruned = restore_vault("vault.luks", keys, "vault", prune=True)
+        # assert
+        assert pruned == ["id_db"]
+        mock_delete.assert_called_once_with(str(vault_mnt / "id_db"))
+        mock_write.assert_called_with(b"web key", str(vault_mnt / "id_web"), 0o600)
@@ -0,0 +1,138 @@
+import json
+import subprocess
+
+import pytest
+
+from ssh_keyman.shard_utils import (
+    add_shard,
+    check_shard_passphrase,
+    get_key_group,
+    open_shards,
+    read_shard_manifest,
+    rebalance_shards,
+)
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    path = tmp_path / "vaults.json"
+    manifest = {
+        "groups": {
+            "prod": {"vault": "prod.luks", "patterns": ["*_prod_*"]},
+            "dev": {"vault": "dev.luks", "patterns": ["*_dev_*"]},
+        }
+    }
+    path.write_text(json.dumps(manifest))
+    return str(path)
+
+
+class TestShardUtils:
+
+    def test_add_shard(self, tmp_path):
+        """Normal flow of add_shard with a new manifest."""
+        manifest_path = str(tmp_path / "vaults.json")
+        # run
+        add_shard(manifest_path, "prod", str(tmp_path / "prod.luks"), ["*_prod_*"])
+        # assert
+        manifest = read_shard_manifest(manifest_path)
+        assert manifest["groups"]["prod"] == {
+            "vault": "prod.luks",
+            "patterns": ["*_prod_*"],
+        }
+
+    def test_add_shard_exists(self, manifest_path):
+        """Exception flow of add_shard when the group already exists."""
+        with pytest.raises(ValueError):
+            add_shard(manifest_path, "prod", "other.luks", ["*"])
+
+    def test_get_key_group(self, manifest_path):
+        """Keys are matched to groups by pattern."""
+        manifest = read_shard_manifest(manifest_path)
+        assert get_key_group(manifest, "id_ed25519_prod_web") == "prod"
+        assert get_key_group(manifest, "id_ed25519_dev_web") == "dev"
+        assert get_key_group(manifest, "id_ed25519_web") is None
+
+    def test_open_shards(self, manifest_path, tmp_path, mocker):
+        """Only the requested shards are opened, each on its own device."""
+        # mock
+        mock_open_vault = mocker.patch(
+            "ssh_keyman.shard_utils.open_luks_vault", side_effect=lambda *a: a[3]
+        )
+        # run
+        mnts = open_shards(manifest_path, ["prod"], "password")
+        # assert
+        assert mnts == {"prod": "/mnt/ssh_keyman_prod"}
+        mock_open_vault.assert_called_once_with(
+            str(tmp_path / "prod.luks"),
+            "password",
+            "ssh_keyman_prod",
+            "/mnt/ssh_keyman_prod",
+        )
+
+    def test_open_shards_failure(self, manifest_path, mocker):
+        """Shards which opened are closed when another shard fails to open."""
+
+        # mock
+        def open_vault(vault_path, passphrase, dev, mnt):
+            if dev == "ssh_keyman_dev":
+                raise PermissionError("Mount point already in use")
+            return mnt
+
+        mocker.patch("ssh_keyman.shard_utils.open_luks_vault", side_effect=open_vault)
+        mock_close_vault = mocker.patch("ssh_keyman.shard_utils.close_luks_vault")
+        # run
+        with pytest.raises(PermissionError):
+            open_shards(manifest_path, ["prod", "dev"], "password")
+        # assert
+        mock_close_vault.assert_called_once_with(
+            "ssh_keyman_prod", "/mnt/ssh_keyman_prod"
+        )
+
+    def test_rebalance_shards(self, manifest_path, mocker):
+        """Misplaced keys are moved to the shard matching their group."""
+        # mock
+        mocker.patch(
+            "ssh_keyman.shard_utils.open_shards",
+            return_value={"prod": "/mnt/prod", "dev": "/mnt/dev"},
+        )
+        mock_close_shards = mocker.patch("ssh_keyman.shard_utils.close_shards")
+        keys = {
+            "/mnt/prod": ["id_prod_web", "id_dev_web", "id_web"],
+            "/mnt/dev": ["id_dev_db"],
+        }
+        mocker.patch(
+            "ssh_keyman.shard_utils.get_ssh_key_list", side_effect=keys.__getitem__
+        )
+        mock_copy = mocker.patch("ssh_keyman.shard_utils.copy_ssh_key")
+        mock_delete = mocker.patch("ssh_keyman.shard_utils.delete_ssh_key")
+        # run
+        moves = rebalance_shards(manifest_path, "password")
+        # assert
+        assert moves == [("id_dev_web", "prod", "dev")]
+        mock_copy.assert_called_once_with("/mnt/prod/id_dev_web", "/mnt/dev")
+        mock_delete.assert_called_once_with("/mnt/prod/id_dev_web")
+        mock_close_shards.assert_called_once()
+
+    def test_open_shards_first_failure(self, manifest_path, mocker):
+        """Other shards are not tried when the first shard fails to open."""
+        # mock
+        mock_open_vault = mocker.patch(
+            "ssh_keyman.shard_utils.open_luks_vault",
+            side_effect=subprocess.CalledProcessError(2, ["cryptsetup"]),
+        )
+        # run
+        with pytest.raises(subprocess.CalledProcessError):
+            open_shards(manifest_path, ["prod", "dev"], "password")
+        # assert
+        mock_open_vault.assert_called_once()
+
+    def test_check_shard_passphrase_wrong(self, manifest_path, mocker):
+        """Exception flow of check_shard_passphrase with a wrong passphrase."""
+        # mock
+        mocker.patch(
+            "ssh_keyman.shard_utils.open_luks_vault",
+            side_effect=subprocess.CalledProcessError(2, ["cryptsetup"]),
+        )
+        # run
+        with pytest.raises(ValueError):
+            check_shard_passphrase(manifest_path, "wrong")
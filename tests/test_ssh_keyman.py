@@ -51,3 +51,91 @@ class TestLuksUtils:
         mock_open_vault.assert_called_once()
         mock_list_keys.assert_called_once()
         mock_close_vault.assert_called_once()
+
+    def test_load_keys_group(self, runner, mocker):
+        """Normal flow of load_keys with a key group."""
+        # mock
+        mocker.patch("getpass.getpass", side_effect=["password"])
+        mock_open_shards = mocker.patch(
+            "ssh_keyman.cli.open_shards", return_value={"prod": "/mnt/test"}
+        )
+        mocker.patch("ssh_keyman.cli.get_ssh_key_list", return_value=["key1"])
+        mock_load_key = mocker.patch("ssh_keyman.cli.load_ssh_key")
+        mock_open_vault = mocker.patch("ssh_keyman.cli.open_luks_vault")
+        mock_close_shards = mocker.patch("ssh_keyman.cli.close_shards")
+        # run
+        with runner.isolated_filesystem():
+            with open("vaults.json", "w") as f:
+                f.write("")
+            result = runner.invoke(
+                ssh_keyman.cli.ssh_keyman, ["load-keys", "vaults.json", "-g", "prod"]
+            )
+        # assert
+        assert result.exit_code == 0
+        mock_open_shards.assert_called_once_with("vaults.json", ("prod",), "password")
+        mock_load_key.assert_called_once_with("/mnt/test/key1")
+        mock_open_vault.assert_not_called()
+        mock_close_shards.assert_called_once_with({"prod": "/mnt/test"})
+
+    def test_restore_new_vault(self, runner, mocker):
+        """Normal flow of restore into a vault which does not exist."""
+        # mock
+        mocker.patch("getpass.getpass", side_effect=["backup", "password", "password"])
+        keys = {"key1": (b"key", 0o600)}
+        mock_read_chain = mocker.patch(
+            "ssh_keyman.cli.read_backup_chain", return_value=keys
+        )
+        mock_create_vault = mocker.patch("ssh_keyman.cli.create_luks_vault")
+        mock_restore_vault = mocker.patch("ssh_keyman.cli.restore_vault")
+        # run
+        with runner.isolated_filesystem():
+            with open("full.enc", "w") as f:
+                f.write("")
+            result = runner.invoke(
+                ssh_keyman.cli.ssh_keyman, ["restore", "vault.luks", "full.enc"]
+            )
+        # assert
+        assert result.exit_code == 0
+        assert "1 keys restored" in result.output
+        mock_read_chain.assert_called_once_with(("full.enc",), "backup")
+        mock_create_vault.assert_called_once_with("vault.luks", 32, "password")
+        mock_restore_vault.assert_called_once_with(
+            "vault.luks", keys, "password", False
+        )
+
+    def test_create_shard_invalid_group(self, runner, mocker):
+        """The vault is not created for an invalid group name."""
+        # mock
+        mock_create_vault = mocker.patch("ssh_keyman.cli.create_luks_vault")
+        # run
+        with runner.isolated_filesystem():
+            result = runner.invoke(
+                ssh_keyman.cli.ssh_keyman,
+                ["create-shard", "vaults.json", "prod/eu", "prod.luks"],
+            )
+        # assert
+        assert result.exit_code == 0
+        mock_create_vault.assert_not_called()
+
+    def test_restore_header_declined(self, runner, mocker):
+        """The LUKS header is not restored without confirmation."""
+        # mock
+        mocker.patch("getpass.getpass", side_effect=["backup"])
+        mocker.patch("ssh_keyman.cli.read_backup_chain", return_value={})
+        mock_restore_header = mocker.patch("ssh_keyman.cli.restore_luks_header")
+        mock_restore_vault = mocker.patch("ssh_keyman.cli.restore_vault")
+        # run
+        with runner.isolated_filesystem():
+            for path in ["vault.luks", "full.enc", "full.enc.header"]:
+                with open(path, "w") as f:
+                    f.write("")
+            result = runner.invoke(
+                ssh_keyman.cli.ssh_keyman,
+                ["restore", "vault.luks", "full.enc", "--header", "full.enc.header"],
+                input="n\n",
+            )
+        # assert
+        assert result.exit_code == 0
+        assert "No keys restored." in result.output
+        mock_restore_header.assert_not_called()
+        mock_restore_vault.assert_not_called()
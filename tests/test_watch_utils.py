@@ -0,0 +1,178 @@
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from ssh_keyman.watch_utils import batch_key_events, import_key_batch, watch_keys
+
+
+class TestWatchUtils:
+
+    def test_batch_key_events(self):
+        """Bursts of paths are debounced into batches of unique paths."""
+        r, w = os.pipe()
+
+        def write_events():
+            os.write(w, b"/staging/id_a\n/staging/id_b\n/staging/id_a\n/sta")
+            os.write(w, b"ging/id_c\n")
+            time.sleep(0.3)
+            os.write(w, b"/staging/id_d\n")
+            os.close(w)
+
+        thread = threading.Thread(target=write_events)
+        thread.start()
+        # run
+        batches = list(batch_key_events(r, 0.1, 10))
+        thread.join()
+        os.close(r)
+        # assert
+        assert batches == [
+            ["/staging/id_a", "/staging/id_b", "/staging/id_c"],
+            ["/staging/id_d"],
+        ]
+
+    def test_batch_key_events_max_wait(self):
+        """A steady stream of paths is flushed once max_wait has passed."""
+        r, w = os.pipe()
+
+        def write_events():
+            for idx in range(6):
+                os.write(w, f"/staging/id_{idx}\n".encode())
+                time.sleep(0.05)
+            os.close(w)
+
+        thread = threading.Thread(target=write_events)
+        thread.start()
+        # run
+        batches = list(batch_key_events(r, 0.2, 0.12))
+        thread.join()
+        os.close(r)
+        # assert
+        assert len(batches) > 1
+        assert sum(batches, []) == [f"/staging/id_{idx}" for idx in range(6)]
+
+    def test_import_key_batch(self, mocker):
+        """Private keys in a batch are imported with the vault opened once."""
+        # mock
+        mocker.patch(
+            "ssh_keyman.watch_utils.is_ssh_private_key",
+            side_effect=lambda path: not path.endswith(".pub"),
+        )
+        mock_open_vault = mocker.patch(
+            "ssh_keyman.watch_utils.open_luks_vault", return_value="/mnt/test"
+        )
+        mock_close_vault = mocker.patch("ssh_keyman.watch_utils.close_luks_vault")
+        mock_import = mocker.patch(
+            "ssh_keyman.watch_utils.import_ssh_keys", return_value=["/s/id_a"]
+        )
+        mock_shred = mocker.patch("ssh_keyman.watch_utils.shred_ssh_key")
+        confirm = mocker.Mock()
+        # run
+        imported = import_key_batch(
+            "vault.luks",
+            "password",
+            ["/s/id_a", "/s/id_a.pub", "/s/id_b"],
+            confirm,
+            remove=True,
+        )
+        # assert
+        assert imported == ["/s/id_a"]
+        mock_open_vault.assert_called_once_with("vault.luks", "password")
+        mock_import.assert_called_once_with(
+            "/mnt/test", ["/s/id_a", "/s/id_b"], confirm
+        )
+        mock_close_vault.assert_called_once()
+        mock_shred.assert_called_once_with("/s/id_a")
+
+    def test_import_key_batch_no_keys(self, mocker):
+        """The vault is not opened for a batch without private keys."""
+        # mock
+        mocker.patch("ssh_keyman.watch_utils.is_ssh_private_key", return_value=False)
+        mock_open_vault = mocker.patch("ssh_keyman.watch_utils.open_luks_vault")
+        # run
+        imported = import_key_batch("vault.luks", "password", ["/s/a.pub"], None)
+        # assert
+        assert imported == []
+        mock_open_vault.assert_not_called()
+
+    def test_watch_keys_retry(self, mocker):
+        """Files of a failed batch are retried with the next batch."""
+        # mock
+        mock_open_vault = mocker.patch("ssh_keyman.watch_utils.open_luks_vault")
+        mocker.patch("ssh_keyman.watch_utils.close_luks_vault")
+        mocker.patch("subprocess.Popen", return_value=mocker.Mock(returncode=-15))
+        mocker.patch(
+            "ssh_keyman.watch_utils.batch_key_events",
+            return_value=iter([["/s/id_a"], ["/s/id_b", "/s/id_a"]]),
+        )
+        mock_import = mocker.patch(
+            "ssh_keyman.watch_utils.import_key_batch",
+            side_effect=[PermissionError("Mount point already in use"), ["/s/id_a"]],
+        )
+        # run
+        watch_keys("vault.luks", "/s", "password", None)
+        # assert
+        mock_open_vault.assert_called_once_with("vault.luks", "password")
+        assert mock_import.call_args_list == [
+            mocker.call("vault.luks", "password", ["/s/id_a"], None, False),
+            mocker.call("vault.luks", "password", ["/s/id_a", "/s/id_b"], None, False),
+        ]
+
+    def test_watch_keys_wrong_passphrase(self, mocker):
+        """A wrong passphrase fails before the directory is watched."""
+        # mock
+        mocker.patch(
+            "ssh_keyman.watch_utils.open_luks_vault",
+            side_effect=subprocess.CalledProcessError(2, ["cryptsetup"]),
+        )
+        mock_popen = mocker.patch("subprocess.Popen")
+        # run
+        with pytest.raises(subprocess.CalledProcessError):
+            watch_keys("vault.luks", "/s", "wrong", None)
+        # assert
+        mock_popen.assert_not_called()
+
+    def test_batch_key_events_idle(self):
+        """An empty batch is yielded after idle seconds without paths."""
+        r, w = os.pipe()
+
+        def write_events():
+            time.sleep(0.3)
+            os.write(w, b"/staging/id_a\n")
+            os.close(w)
+
+        thread = threading.Thread(target=write_events)
+        thread.start()
+        # run
+        batches = list(batch_key_events(r, 0.05, 10, idle=0.1))
+        thread.join()
+        os.close(r)
+        # assert
+        assert batches[0] == []
+        assert batches[-1] == ["/staging/id_a"]
+        assert all(batch == [] for batch in batches[:-1])
+
+    def test_watch_keys_retry_idle(self, mocker):
+        """A failed batch is retried when the directory goes quiet."""
+        # mock
+        mocker.patch("ssh_keyman.watch_utils.open_luks_vault")
+        mocker.patch("ssh_keyman.watch_utils.close_luks_vault")
+        mocker.patch("subprocess.Popen", return_value=mocker.Mock(returncode=-15))
+        mock_batches = mocker.patch(
+            "ssh_keyman.watch_utils.batch_key_events",
+            return_value=iter([[], ["/s/id_a"], [], []]),
+        )
+        mock_import = mocker.patch(
+            "ssh_keyman.watch_utils.import_key_batch",
+            side_effect=[PermissionError("Mount point already in use"), ["/s/id_a"]],
+        )
+        # run
+        watch_keys("vault.luks", "/s", "password", None, max_wait=5)
+        # assert
+        assert mock_batches.call_args.kwargs == {"idle": 5}
+        assert mock_import.call_args_list == [
+            mocker.call("vault.luks", "password", ["/s/id_a"], None, False),
+            mocker.call("vault.luks", "password", ["/s/id_a"], None, False),
+        ]